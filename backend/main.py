@@ -1,35 +1,56 @@
+import asyncio
+import hashlib
+import importlib.util
+import json
 import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import Response
+from pydantic import BaseModel, Field, model_validator
 
 import time
-from typing import Optional, List
-from pathlib import Path
+from typing import Literal, Optional, List, Tuple
 
+# The CUDA allocator reads its configuration on first use, so it has to be set before torch is imported
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,max_split_size_mb:128,garbage_collection_threshold:0.8",
+)
+
+import numpy as np
 import torch
-from transformers import AutoProcessor, DiaForConditionalGeneration
+from transformers import AutoProcessor, DiaForConditionalGeneration, TorchAoConfig
 
-from utils import process_audio_prompt
+from utils import DIA_SAMPLE_RATE, finalize_audio, process_audio_prompt
 
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     handlers=[logging.StreamHandler()],
 )
 logger = logging.getLogger(__name__)
 
-AUDIO_DIR = Path("audio_files")
-AUDIO_DIR.mkdir(exist_ok=True)
-UPLOADS_DIR = Path("upload_files")
-UPLOADS_DIR.mkdir(exist_ok=True)
-
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-
-logger.info(f"Using DEVICE: {DEVICE}")
+CUDA_MEMORY_FRACTION = 0.9
+# Opt-in weight-only quantization: "int8", or "fp8" on Hopper GPUs (torchao), or "int8" on CPU (torch.ao dynamic)
+QUANTIZATION = os.getenv("DIA_QUANTIZE")
+QUANTIZATION_TYPES = {"cuda": ("int8", "fp8"), "cpu": ("int8",)}
+
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT_SECONDS = 0.02
+MAX_QUEUED_REQUESTS = 100
+PROMPT_CACHE_SIZE = 16
+WARMUP_TEXT = "[S1] Hello, this is a warmup."
+# torch.compile's "reduce-overhead" mode records CUDA graphs only after a warm-up call, so capture happens on the second run
+WARMUP_RUNS = 2
+RESPONSE_CACHE_SIZE = 64
+
+logger.info("Using DEVICE: %s", DEVICE)
 
 class ModelManager:
     """Manages the loading, unloading and access to the Dia model and processor using Hugging Face Transformers."""
@@ -38,37 +59,122 @@ class ModelManager:
         self.device = DEVICE
         self.dtype_map = {
             "cpu": torch.float32,
-            "cuda": torch.float16,  
         }
         self.model = None
         self.processor = None
+        self.replicas = []
         self.model_id = "nari-labs/Dia-1.6B-0626"
 
+    @staticmethod
+    def get_cuda_dtype(device: str) -> torch.dtype:
+        """Prefer bfloat16 on Ampere and newer GPUs for its float32 exponent range; older GPUs fall back to float16."""
+        if torch.cuda.get_device_capability(device)[0] >= 8:
+            return torch.bfloat16
+        return torch.float16
+
+    def get_dtype(self, device: str) -> torch.dtype:
+        """Pick the compute dtype per device, so replicas on mixed GPU generations each get the best one they support."""
+        if self.device == "cuda":
+            return self.get_cuda_dtype(device)
+        return self.dtype_map.get(self.device, torch.float16)
+
+    def get_devices(self) -> List[str]:
+        """List the devices to place model replicas on: every visible GPU, or the single configured device."""
+        if self.device == "cuda":
+            return [f"cuda:{index}" for index in range(torch.cuda.device_count())]
+        return [self.device]
+
     def load_model(self):
-        """Load the Dia model and processor with appropriate configuration using Hugging Face Transformers."""
+        """Load one Dia model and processor replica per device using Hugging Face Transformers."""
         try:
-            dtype = self.dtype_map.get(self.device, torch.float16)
-            logger.info(f"Loading model and processor with {dtype} on {self.device}")
-            self.processor = AutoProcessor.from_pretrained(self.model_id)
-            self.model = DiaForConditionalGeneration.from_pretrained(
-                self.model_id,
-                torch_dtype=dtype,
-                device_map=self.device
-            )
-            logger.info("Model and processor loaded successfully")
+            if QUANTIZATION:
+                self.check_quantization()
+            for device in self.get_devices():
+                self.replicas.append(self.load_replica(device))
+            self.model, self.processor = self.replicas[0]
+            logger.info("Model and processor loaded successfully on %d device(s)", len(self.replicas))
         except Exception as e:
-            logger.error(f"Error loading model or processor: {e}")
+            logger.error("Error loading model or processor: %s", e)
             raise
 
+    def load_replica(self, device: str) -> Tuple[DiaForConditionalGeneration, AutoProcessor]:
+        """Load the Dia model and processor onto a single device with appropriate configuration."""
+        dtype = self.get_dtype(device)
+        if self.device == "cuda":
+            torch.cuda.set_per_process_memory_fraction(CUDA_MEMORY_FRACTION, device)
+        logger.info("Loading model and processor with %s on %s", dtype, device)
+        processor = AutoProcessor.from_pretrained(self.model_id)
+        model = DiaForConditionalGeneration.from_pretrained(
+            self.model_id,
+            torch_dtype=dtype,
+            device_map=device,
+            attn_implementation=self.get_attn_implementation(),
+            quantization_config=self.get_quantization_config()
+        )
+        if self.device == "cuda":
+            # The processor loads its DAC audio tokenizer on the CPU; keep prompt encoding and
+            # waveform decoding on the GPU so only the final waveform is copied back to the host
+            processor.audio_tokenizer.to(device)
+            self.enable_compiled_decoding(model)
+        elif self.device == "cpu" and QUANTIZATION:
+            model = self.quantize_dynamic(model)
+        return model, processor
+
+    def get_attn_implementation(self) -> str:
+        """Use FlashAttention-2 on CUDA when flash_attn is installed, otherwise PyTorch's fused SDPA kernels."""
+        if self.device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return "sdpa"
+
+    def check_quantization(self):
+        """
+        Validate DIA_QUANTIZE against the types supported on this device. Decoding re-reads every weight per token,
+        so smaller weights mean proportionally less memory traffic. Both quantization paths leave the logits head
+        (logits_dense) in full precision to keep sampling numerically stable.
+        """
+        supported = QUANTIZATION_TYPES.get(self.device, ())
+        if QUANTIZATION not in supported:
+            raise ValueError(f"Unsupported DIA_QUANTIZE value {QUANTIZATION!r} on {self.device}, expected one of {list(supported)}")
+
+    def get_quantization_config(self) -> Optional[TorchAoConfig]:
+        """Build the torchao weight-only config selected by DIA_QUANTIZE, or None to keep full-precision weights."""
+        if not QUANTIZATION or self.device == "cpu":
+            return None
+        from torchao.quantization import Float8WeightOnlyConfig, Int8WeightOnlyConfig
+
+        quant_types = {"int8": Int8WeightOnlyConfig, "fp8": Float8WeightOnlyConfig}
+        logger.info("Quantizing model weights to %s", QUANTIZATION)
+        return TorchAoConfig(quant_types[QUANTIZATION](), modules_to_not_convert=["logits_dense"])
+
+    @staticmethod
+    def quantize_dynamic(model: DiaForConditionalGeneration) -> DiaForConditionalGeneration:
+        """Quantize the encoder-decoder's Linear weights to int8 with PyTorch's built-in dynamic quantization, without torchao."""
+        logger.info("Dynamically quantizing Linear weights to int8")
+        torch.ao.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model
+
+    def enable_compiled_decoding(self, model: DiaForConditionalGeneration):
+        """
+        Switch generation to a static KV cache so Transformers compiles the decoder forward
+        with torch.compile in "reduce-overhead" mode, replaying each decode step as a CUDA graph.
+        """
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision("high")
+        model.generation_config.cache_implementation = "static"
+        logger.info("Enabled static KV cache for compiled decoding")
+
     def unload_model(self):
         """Cleanup method to properly unload the model and processor."""
         try:
             del self.model
             del self.processor
+            self.replicas.clear()
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
         except Exception as e:
-            logger.error(f"Error unloading model or processor: {e}")
+            logger.error("Error unloading model or processor: %s", e)
 
     def get_model(self):
         if self.model is None:
@@ -80,29 +186,239 @@ class ModelManager:
             raise RuntimeError("Processor not loaded. Call load_model() first.")
         return self.processor
 
+    def get_replicas(self) -> List[Tuple[DiaForConditionalGeneration, AutoProcessor]]:
+        if not self.replicas:
+            raise RuntimeError("Model not loaded. Call load_model() first.")
+        return self.replicas
+
 model_manager = ModelManager()
 
 class AudioPrompt(BaseModel):
-    sample_rate: int
-    audio_data: List[float]  
+    """Audio prompt samples, either as a JSON list or as base64-encoded little-endian bytes of the given dtype."""
+    sample_rate: int = Field(..., ge=8000, le=192000)
+    audio_data: Optional[List[float]] = None
+    # Kept as a string so the (strict) base64 decode runs in process_audio_prompt's worker thread, not the event loop
+    audio_data_b64: Optional[str] = None
+    dtype: Literal["float32", "int16"] = "float32"
+
+    @model_validator(mode="after")
+    def check_single_payload(self):
+        if (self.audio_data is None) == (self.audio_data_b64 is None):
+            raise ValueError("Provide exactly one of audio_data or audio_data_b64.")
+        if self.audio_data is not None and self.dtype != "float32":
+            raise ValueError("dtype only applies to audio_data_b64; audio_data must hold float samples in [-1, 1].")
+        return self
 
 class GenerateRequest(BaseModel):
     text_input: str
     audio_prompt: Optional[AudioPrompt] = None
-    max_new_tokens: int = 1024
-    cfg_scale: float = 3.0
-    temperature: float = 1.3
-    top_p: float = 0.95
-    cfg_filter_top_k: int = 35
-    speed_factor: float = 0.94
+    max_new_tokens: int = Field(1024, ge=860, le=3072)
+    cfg_scale: float = Field(3.0, ge=1.0, le=5.0)
+    temperature: float = Field(1.3, ge=1.0, le=1.5)
+    top_p: float = Field(0.95, ge=0.8, le=1.0)
+    cfg_filter_top_k: int = Field(35, ge=15, le=50)
+    speed_factor: float = Field(0.94, ge=0.8, le=1.0)
+
+generation_queue: asyncio.Queue = asyncio.Queue(maxsize=MAX_QUEUED_REQUESTS)
+
+response_cache: "OrderedDict[str, memoryview]" = OrderedDict()
+
+def batch_key(request: GenerateRequest, prompt_key: Optional[str]) -> Tuple:
+    """Requests can share a model.generate call only if they sample identically and use the same audio prompt."""
+    return (
+        prompt_key,
+        request.max_new_tokens,
+        request.cfg_scale,
+        request.temperature,
+        request.top_p,
+        request.cfg_filter_top_k,
+    )
+
+def response_cache_key(request: GenerateRequest, prompt_key: Optional[str]) -> str:
+    """Hash everything that determines the generated audio: text, sampling parameters and audio prompt content."""
+    params = request.model_dump(exclude={"audio_prompt"})
+    params["audio_prompt"] = prompt_key
+    return hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+def cache_response(cache_key: str, wav_bytes: memoryview) -> None:
+    """Record generated audio in the response cache, dropping the least recently used entry once full."""
+    response_cache[cache_key] = wav_bytes
+    if len(response_cache) > RESPONSE_CACHE_SIZE:
+        response_cache.popitem(last=False)
+
+def wav_response(wav_bytes: memoryview, filename: str) -> Response:
+    """Return encoded WAV bytes directly from memory, without copying them, as a downloadable audio response."""
+    return Response(
+        content=wav_bytes,
+        media_type="audio/wav",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def collect_batch() -> list:
+    """Wait for one queued request, then keep draining the queue until the batch is full or the wait window closes."""
+    batch = [await generation_queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MAX_BATCH_WAIT_SECONDS
+    while len(batch) < MAX_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(generation_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+def encode_audio_prompt(
+    processor, device, prompt_cache: "OrderedDict[str, dict]", prompt_key: str, prompt_audio: np.ndarray
+) -> dict:
+    """
+    Return the decoder inputs for an audio prompt, encoding it with the audio tokenizer only on a cache miss.
+    The encoded prompt depends on the audio alone, so it is reused across requests with different texts,
+    and is kept on the model device so cache hits need no host-to-device copy.
+    Each replica owns its cache and only touches it from its single executor thread, so no locking is needed.
+    """
+    if prompt_key in prompt_cache:
+        prompt_cache.move_to_end(prompt_key)
+        return prompt_cache[prompt_key]
+
+    prompt_inputs = processor(
+        text=[""],
+        audio=[prompt_audio],
+        sampling_rate=DIA_SAMPLE_RATE,
+        padding=True,
+        return_tensors="pt"
+    )
+    encoded = {
+        "decoder_input_ids": prompt_inputs["decoder_input_ids"].to(device),
+        "decoder_attention_mask": prompt_inputs["decoder_attention_mask"].to(device),
+    }
+    prompt_cache[prompt_key] = encoded
+    if len(prompt_cache) > PROMPT_CACHE_SIZE:
+        prompt_cache.popitem(last=False)
+    return encoded
+
+def generate_batch(
+    model,
+    processor,
+    prompt_cache: "OrderedDict[str, dict]",
+    requests: List[GenerateRequest],
+    prompt: Optional[Tuple[str, np.ndarray]],
+) -> list:
+    """Run a single model.generate call for requests sharing the same batch key and decode the outputs."""
+    params = requests[0]
+
+    start_time = time.time()
+
+    processor_inputs = processor(
+        text=[request.text_input for request in requests],
+        padding=True,
+        return_tensors="pt"
+    ).to(model.device, non_blocking=True)
+
+    audio_prompt_len = None
+    if prompt is not None:
+        prompt_inputs = encode_audio_prompt(processor, model.device, prompt_cache, *prompt)
+        processor_inputs["decoder_input_ids"] = prompt_inputs["decoder_input_ids"].repeat(len(requests), 1, 1)
+        processor_inputs["decoder_attention_mask"] = prompt_inputs["decoder_attention_mask"].repeat(len(requests), 1)
+        audio_prompt_len = processor.get_audio_prompt_len(processor_inputs["decoder_attention_mask"])
+
+    with torch.inference_mode():
+        logger.debug("Starting generation for batch of %d with audio prompt: %s", len(requests), prompt is not None)
+        outputs = model.generate(
+            **processor_inputs,
+            max_new_tokens=params.max_new_tokens,
+            guidance_scale=params.cfg_scale,
+            temperature=params.temperature,
+            top_p=params.top_p,
+            top_k=params.cfg_filter_top_k
+        )
+        logger.debug("Generation completed. Output shape: %s", tuple(outputs.shape))
+
+    decoded = processor.batch_decode(outputs, audio_prompt_len=audio_prompt_len)
+
+    end_time = time.time()
+    logger.info("Generation of %d requests finished in %.2f seconds.", len(requests), end_time - start_time)
+    return decoded
+
+async def warmup(model, processor, prompt_cache: "OrderedDict[str, dict]", executor: ThreadPoolExecutor):
+    """
+    Run default-sized generations so compilation, CUDA-graph capture and autotuning happen before the first real request.
+    The static cache is sized from max_length, so warming up at the frontend's default token budget compiles the shapes
+    real requests reuse.
+    """
+    logger.info("Warming up model on %s...", model.device)
+    start_time = time.time()
+    request = GenerateRequest(text_input=WARMUP_TEXT)
+    for _ in range(WARMUP_RUNS):
+        await asyncio.get_running_loop().run_in_executor(
+            executor, generate_batch, model, processor, prompt_cache, [request], None
+        )
+    logger.info("Warmup on %s finished in %.2f seconds.", model.device, time.time() - start_time)
+
+async def batch_worker(model, processor, prompt_cache: "OrderedDict[str, dict]", executor: ThreadPoolExecutor):
+    """
+    Consume the generation queue, coalescing compatible requests into batched model.generate calls.
+    Each model replica runs its own worker on the shared queue, so whichever replica is idle takes the next batch.
+    Generation runs on the replica's executor thread so the event loop keeps serving other routes meanwhile,
+    and the replica's prompt cache is only ever touched from that thread.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await collect_batch()
+
+        groups = {}
+        for request, prompt, future in batch:
+            prompt_key = prompt[0] if prompt is not None else None
+            groups.setdefault(batch_key(request, prompt_key), []).append((request, prompt, future))
+
+        for items in groups.values():
+            prompt = items[0][1]
+            try:
+                decoded = await loop.run_in_executor(
+                    executor,
+                    generate_batch,
+                    model,
+                    processor,
+                    prompt_cache,
+                    [request for request, _, _ in items],
+                    prompt,
+                )
+            except Exception as e:
+                logger.error("Error during batched generation: %s", e)
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, _, future), audio in zip(items, decoded):
+                if not future.done():
+                    future.set_result(audio)
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     """Handle model lifecycle during application startup and shutdown."""
     logger.info("Starting up application...")
     model_manager.load_model()
+    workers = []
+    # Each replica's GPU is its serialization point, so a single thread runs all of its generations
+    executors = [ThreadPoolExecutor(max_workers=1) for _ in model_manager.get_replicas()]
+    # Encoded prompts live on a replica's device, so each replica keeps its own cache
+    prompt_caches = [OrderedDict() for _ in model_manager.get_replicas()]
+    replicas = list(zip(model_manager.get_replicas(), prompt_caches, executors))
+    if model_manager.device == "cuda":
+        await asyncio.gather(*(
+            warmup(model, processor, prompt_cache, executor)
+            for (model, processor), prompt_cache, executor in replicas
+        ))
+    for (model, processor), prompt_cache, executor in replicas:
+        workers.append(asyncio.create_task(batch_worker(model, processor, prompt_cache, executor)))
     yield
     logger.info("Shutting down application...")
+    for worker in workers:
+        worker.cancel()
+    for executor in executors:
+        executor.shutdown(wait=False, cancel_futures=True)
     model_manager.unload_model()
     logger.info("Application shut down successfully")
 
@@ -129,63 +445,44 @@ async def health_check():
 @app.post("/api/generate")
 async def run_inference(request: GenerateRequest):
     """
-    Runs Dia inference using the model and processor from model_manager and provided inputs.
-    Uses temporary files for audio prompt compatibility with inference.generate.
+    Runs Dia inference by queueing the request for the batch worker and awaiting its decoded audio.
+    An audio prompt is keyed by its content so its encoding can be reused by later requests.
     """
     if not request.text_input or request.text_input.isspace():
         raise HTTPException(status_code=400, detail="Text input cannot be empty.")
 
-    output_filepath = AUDIO_DIR / f"{int(time.time())}.wav"
-
     try:
-        prompt_path_for_generate = None
+        prompt = None
         if request.audio_prompt is not None:
-            prompt_path_for_generate = process_audio_prompt(request.audio_prompt)
-
-        model = model_manager.get_model()
-        processor = model_manager.get_processor()
-
-        start_time = time.time()
+            # Decoding, hashing and resampling a long prompt is CPU work that would otherwise stall the event loop
+            prompt = await asyncio.to_thread(process_audio_prompt, request.audio_prompt)
+        prompt_key = prompt[0] if prompt is not None else None
+
+        cache_key = response_cache_key(request, prompt_key)
+        filename = f"{cache_key}.wav"
+        cached_wav = response_cache.get(cache_key)
+        if cached_wav is not None:
+            response_cache.move_to_end(cache_key)
+            logger.info("Serving cached audio %s", filename)
+            return wav_response(cached_wav, filename)
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            generation_queue.put_nowait((request, prompt, future))
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Server is busy, please retry shortly.")
 
-        processor_inputs = processor(
-            text=[request.text_input],
-            padding=True,
-            return_tensors="pt"
-        )
-        processor_inputs = {k: v.to(model.device) for k, v in processor_inputs.items()}
-
-        if prompt_path_for_generate is not None:
-            processor_inputs["audio_prompt"] = prompt_path_for_generate
-
-        with torch.inference_mode():
-            logger.info(f"Starting generation with audio prompt: {prompt_path_for_generate}")
-            outputs = model.generate(
-                **processor_inputs,
-                max_new_tokens=request.max_new_tokens,
-                guidance_scale=request.cfg_scale,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.cfg_filter_top_k
-            )
-            logger.info(f"Generation completed. Output shape: {outputs.shape if hasattr(outputs, 'shape') else type(outputs)}")
-
-        decoded = processor.batch_decode(outputs)
-        processor.save_audio(decoded, str(output_filepath))
-        logger.info(f"Audio saved to {output_filepath}")
-
-        end_time = time.time()
-        logger.info(f"Generation finished in {end_time - start_time:.2f} seconds.")
-
-        return FileResponse(
-            path=str(output_filepath),
-            media_type="audio/wav",
-            filename=output_filepath.name
+        audio = await future
+        wav_bytes = await asyncio.to_thread(
+            finalize_audio, audio.float().numpy(), request.speed_factor, DIA_SAMPLE_RATE
         )
+        logger.info("Encoded %s (%d bytes)", filename, len(wav_bytes))
+        cache_response(cache_key, wav_bytes)
+
+        return wav_response(wav_bytes, filename)
 
     except Exception as e:
-        logger.error(f"Error during inference: {e}")
+        logger.error("Error during inference: %s", e)
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
-
-
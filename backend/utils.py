@@ -1,77 +1,159 @@
+import base64
+import binascii
+import hashlib
 import logging
+import struct
 import numpy as np
-import tempfile
-import soundfile as sf
 from fastapi import HTTPException
-from typing import Optional, List
-from pydantic import BaseModel
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler()],
-)
+from typing import Optional, Tuple
+
 logger = logging.getLogger(__name__)
 
+DIA_SAMPLE_RATE = 44100
+SPEED_FACTOR_TOLERANCE = 1e-6
+SILENCE_SCAN_CHUNK = 4096
+# Reciprocal full-scale values for the supported integer PCM sample formats
+PCM_SCALES = {np.dtype(pcm_dtype): np.float32(1.0 / np.iinfo(pcm_dtype).max) for pcm_dtype in (np.int16, np.int32)}
+# Canonical 44-byte RIFF/WAVE header for a single PCM fmt chunk followed by the data chunk
+WAV_HEADER = struct.Struct("<4sI4s4sIHHIIHH4sI")
+# Little-endian wire formats accepted for base64-encoded audio prompts
+BASE64_DTYPES = {"float32": "<f4", "int16": "<i2"}
+
 def is_audio_empty_or_silent(audio_data: np.ndarray) -> bool:
     """Check if audio data is empty, None, or silent."""
-    return audio_data is None or audio_data.size == 0 or audio_data.max() == 0
+    if audio_data is None or audio_data.size == 0:
+        return True
+    # Real prompts have nonzero samples right away, so scan in small blocks and stop at the first one
+    flat = audio_data.ravel()
+    for start in range(0, flat.size, SILENCE_SCAN_CHUNK):
+        if flat[start:start + SILENCE_SCAN_CHUNK].any():
+            return False
+    return True
 
 def normalize_audio_dtype(audio_data: np.ndarray) -> np.ndarray:
-    """Convert audio data to float32 format."""
-    if np.issubdtype(audio_data.dtype, np.integer):
-        max_val = np.iinfo(audio_data.dtype).max
-        return audio_data.astype(np.float32) / max_val
-    elif not np.issubdtype(audio_data.dtype, np.floating):
-        logger.warning(f"Unsupported audio prompt dtype {audio_data.dtype}, attempting conversion.")
-        try:
-            return audio_data.astype(np.float32)
-        except Exception as conv_e:
-            raise HTTPException(status_code=400, detail=f"Failed to convert audio prompt to float32: {conv_e}")
-    return audio_data
+    """Convert audio data to float32 format, scaling integer PCM onto [-1, 1]."""
+    scale = PCM_SCALES.get(audio_data.dtype)
+    if scale is not None:
+        return np.multiply(audio_data, scale, dtype=np.float32)
+    if audio_data.dtype.kind != "f":
+        raise HTTPException(status_code=400, detail=f"Unsupported audio prompt dtype {audio_data.dtype}.")
+    return audio_data.astype(np.float32, copy=False)
 
 def convert_to_mono(audio_data: np.ndarray) -> np.ndarray:
-    """Convert multi-channel audio to mono."""
+    """Convert multi-channel audio to mono, averaging stereo channels into a preallocated float32 buffer."""
     if audio_data.ndim > 1:
-        if audio_data.shape[0] == 2: 
-            audio_data = np.mean(audio_data, axis=0)
-        elif audio_data.shape[1] == 2: 
-            audio_data = np.mean(audio_data, axis=1)
+        if audio_data.shape[0] == 2:
+            left, right = audio_data[0], audio_data[1]
+        elif audio_data.shape[1] == 2:
+            left, right = audio_data[:, 0], audio_data[:, 1]
         else:
-            logger.warning(f"Audio prompt has unexpected shape {audio_data.shape}, taking first channel/axis.")
+            logger.warning("Audio prompt has unexpected shape %s, taking first channel/axis.", audio_data.shape)
             audio_data = audio_data[0] if audio_data.shape[0] < audio_data.shape[1] else audio_data[:, 0]
-        audio_data = np.ascontiguousarray(audio_data)
+            return np.ascontiguousarray(audio_data)
+        mono = np.empty(left.shape[0], dtype=np.float32)
+        np.add(left, right, out=mono, dtype=np.float32)
+        mono *= 0.5
+        return mono
     return audio_data
 
-def save_audio_to_temp_file(audio_data: np.ndarray, sample_rate: int) -> str:
-    """Save audio data to a temporary WAV file and return the file path."""
-    with tempfile.NamedTemporaryFile(mode="wb", suffix=".wav", delete=False) as f_audio:
-        temp_path = f_audio.name
-    
+def resample_audio(audio_data: np.ndarray, target_len: int) -> np.ndarray:
+    """
+    Resample mono audio to target_len samples with band-limited (FFT) interpolation.
+    The spectrum is zero-padded when stretching and truncated when shrinking, which avoids aliasing.
+    """
+    original_len = len(audio_data)
+    if target_len == original_len:
+        return audio_data
+    spectrum = np.fft.rfft(audio_data)
+    target_bins = target_len // 2 + 1
+    kept_bins = min(target_bins, spectrum.size)
+    # Apply the length normalization to the half-size spectrum while copying it, instead of an extra pass over the output
+    resized = np.zeros(target_bins, dtype=spectrum.dtype)
+    np.multiply(spectrum[:kept_bins], target_len / original_len, out=resized[:kept_bins])
+    # NumPy computes float32 FFTs natively, so float32 input stays float32 end to end
+    return np.fft.irfft(resized, n=target_len).astype(np.float32, copy=False)
+
+def apply_speed_factor(audio_data: np.ndarray, speed_factor: float) -> np.ndarray:
+    """Speed up (factor > 1) or slow down (factor < 1) generated audio by resampling it."""
+    if abs(speed_factor - 1.0) <= SPEED_FACTOR_TOLERANCE:
+        return audio_data
+    original_len = len(audio_data)
+    target_len = int(original_len / speed_factor)
+    if target_len != original_len and target_len > 0:
+        logger.debug("Applying speed factor %s: %d -> %d samples", speed_factor, original_len, target_len)
+        return resample_audio(audio_data, target_len)
+    return audio_data
+
+def encode_wav(audio_data: np.ndarray, sample_rate: int) -> memoryview:
+    """
+    Encode mono float audio as an in-memory 16-bit PCM WAV. The output buffer is allocated once at its final size:
+    the RIFF header is packed into its start, and the audio is quantized straight into the little-endian int16 view
+    of the rest, so the samples are never copied after conversion.
+    Scaling, clipping and rounding happen in place, so audio_data is overwritten and must not be reused by the caller.
+    """
+    data_size = len(audio_data) * 2
+    wav = bytearray(WAV_HEADER.size + data_size)
+    WAV_HEADER.pack_into(
+        wav, 0,
+        b"RIFF", WAV_HEADER.size - 8 + data_size, b"WAVE",
+        b"fmt ", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b"data", data_size,
+    )
+    np.multiply(audio_data, 32767.0, out=audio_data)
+    np.clip(audio_data, -32767.0, 32767.0, out=audio_data)
+    # Round to nearest before the cast, which would otherwise truncate toward zero
+    np.rint(audio_data, out=audio_data)
+    pcm = np.frombuffer(wav, dtype="<i2", offset=WAV_HEADER.size)
+    np.copyto(pcm, audio_data, casting="unsafe")
+    return memoryview(wav)
+
+def finalize_audio(audio_data: np.ndarray, speed_factor: float, sample_rate: int) -> memoryview:
+    """Apply the speed factor to generated audio and encode it as a WAV buffer, as one blocking step for a worker thread."""
+    return encode_wav(apply_speed_factor(audio_data, speed_factor), sample_rate)
+
+def hash_audio(audio_data: np.ndarray, sample_rate: int) -> str:
+    """
+    Digest audio samples, their dtype and their sample rate with SHA-256, which OpenSSL accelerates with SHA-NI where
+    available. The dtype is part of the key because the same bytes decode to different audio as float32 and int16.
+    """
+    digest = hashlib.sha256(np.ascontiguousarray(audio_data))
+    digest.update(audio_data.dtype.str.encode())
+    digest.update(str(sample_rate).encode())
+    return digest.hexdigest()
+
+def decode_audio_data(audio_prompt) -> np.ndarray:
+    """Read the prompt samples, viewing base64 payloads in their declared dtype without per-sample parsing."""
+    if audio_prompt.audio_data_b64 is None:
+        return np.asarray(audio_prompt.audio_data, dtype=np.float32)
     try:
-        sf.write(temp_path, audio_data, sample_rate, subtype="FLOAT")
-        logger.info(f"Created temporary audio prompt file: {temp_path} (sr: {sample_rate}, shape: {audio_data.shape}, max: {audio_data.max():.3f}, min: {audio_data.min():.3f})")
-        return temp_path
-    except Exception as write_e:
-        logger.error(f"Error writing temporary audio file: {write_e}")
-        raise HTTPException(status_code=400, detail=f"Failed to save audio prompt: {write_e}")
-
-def process_audio_prompt(audio_prompt) -> Optional[str]:
+        raw = base64.b64decode(audio_prompt.audio_data_b64, validate=True)
+        return np.frombuffer(raw, dtype=BASE64_DTYPES[audio_prompt.dtype])
+    except (binascii.Error, ValueError) as decode_e:
+        raise HTTPException(status_code=400, detail=f"Failed to decode audio prompt: {decode_e}")
+
+def process_audio_prompt(audio_prompt) -> Optional[Tuple[str, np.ndarray]]:
     """
-    Process the audio prompt input and return the path to the temporary audio file.
-    Returns None if the audio is empty or silent.
+    Process the audio prompt input into mono float32 audio at Dia's sample rate.
+    Returns the digest of the submitted audio alongside the processed audio, or None if the audio is empty or silent.
     """
-    audio_data = np.array(audio_prompt.audio_data, dtype=np.float32)
+    audio_data = decode_audio_data(audio_prompt)
     sample_rate = audio_prompt.sample_rate
 
     if is_audio_empty_or_silent(audio_data):
         logger.warning("Audio prompt seems empty or silent, ignoring prompt.")
         return None
 
-    logger.info(f"Processing audio prompt: shape={audio_data.shape}, sample_rate={sample_rate}, dtype={audio_data.dtype}")
+    logger.info("Processing audio prompt: shape=%s, sample_rate=%d, dtype=%s", audio_data.shape, sample_rate, audio_data.dtype)
+    audio_digest = hash_audio(audio_data, sample_rate)
     
     audio_data = normalize_audio_dtype(audio_data)
 
     audio_data = convert_to_mono(audio_data)
-    
-    return save_audio_to_temp_file(audio_data, sample_rate)
+
+    if sample_rate != DIA_SAMPLE_RATE:
+        target_len = int(len(audio_data) * DIA_SAMPLE_RATE / sample_rate)
+        if target_len == 0:
+            raise HTTPException(status_code=400, detail="Audio prompt is too short to resample.")
+        audio_data = resample_audio(audio_data, target_len)
+
+    return audio_digest, audio_data